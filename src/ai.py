@@ -1,24 +1,84 @@
+import asyncio
+import hashlib
+import logging
 import os
+from contextlib import aclosing
+from typing import AsyncIterator, Optional, Union
 
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+from cache import SemanticCache
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 api_key = os.getenv("OPENAI_API_KEY")
 model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 business_kind = os.getenv("BUSINESS_KIND", "business")
 business_name = os.getenv("BUSINESS_NAME", "Our Store")
 business_address = os.getenv("ADDRESS", "Av. Siempre Viva 742, Springfield")
+max_concurrent_requests = int(os.getenv("OPENAI_MAX_CONCURRENCY", "50"))
+prompt_cache_key_enabled = os.getenv("OPENAI_PROMPT_CACHE_KEY", "true").lower() in ("1", "true", "yes")
+semantic_cache_enabled = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+semantic_cache_threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+semantic_cache_ttl = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
 
 if not api_key:
     raise RuntimeError("Missing required environment variable: OPENAI_API_KEY")
 
-client = OpenAI(api_key=api_key)
+client = AsyncOpenAI(
+    api_key=api_key,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    ),
+)
+prompt_cache_key = (
+    "orderflow-" + hashlib.sha256(business_name.encode("utf-8")).hexdigest()[:16]
+    if prompt_cache_key_enabled
+    else None
+)
+_request_slots = asyncio.Semaphore(max_concurrent_requests)
+
+ORDER_READY_SIGNAL = "ORDER_READY"
+ORDER_FAILED_MESSAGE = "Sorry, we couldn't process your order. Please try again."
+ORDER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "products": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "product": {"type": "string"},
+                    "quantity": {"type": "integer"},
+                    "unit_price": {"type": "number"},
+                },
+                "required": ["product", "quantity", "unit_price"],
+                "additionalProperties": False,
+            },
+        },
+        "total_price": {"type": "number"},
+        "address": {"type": "string"},
+    },
+    "required": ["products", "total_price", "address"],
+    "additionalProperties": False,
+}
+_ORDER_KEYS = frozenset(ORDER_SCHEMA["required"])
+_ORDER_ITEM_KEYS = frozenset(ORDER_SCHEMA["properties"]["products"]["items"]["required"])
+semantic_cache = SemanticCache(
+    client,
+    score_threshold=semantic_cache_threshold,
+    ttl=semantic_cache_ttl,
+)
 
 
-def send_prompt(prompt: str, system_message: str) -> str:
+async def send_prompt(prompt: str, system_message: str) -> str:
     messages = []
     
     if system_message:
@@ -27,32 +87,60 @@ def send_prompt(prompt: str, system_message: str) -> str:
     messages.append({"role": "user", "content": prompt})
     
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.8,
-        )
+        async with _request_slots:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.8,
+            )
         
         return response.choices[0].message.content.strip()
     except Exception as exc:
         raise Exception(f"OpenAI API call failed: {exc}") from exc
 
 
-def send_prompt_with_history(
-    messages: list[dict[str, str]], temperature: float = 0.7
+async def send_prompt_with_history(
+    messages: list[dict[str, str]],
+    temperature: float = 0.7,
+    prompt_cache_key: Optional[str] = None,
 ) -> str:
+    extra_body = {"prompt_cache_key": prompt_cache_key} if prompt_cache_key else None
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-        )
+        async with _request_slots:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                extra_body=extra_body,
+            )
         
         return response.choices[0].message.content.strip()
     except Exception as exc:
         raise Exception(f"OpenAI API call failed: {exc}") from exc
 
 
+async def stream_prompt_with_history(
+    messages: list[dict[str, str]],
+    temperature: float = 0.7,
+    prompt_cache_key: Optional[str] = None,
+) -> AsyncIterator[str]:
+    extra_body = {"prompt_cache_key": prompt_cache_key} if prompt_cache_key else None
+    try:
+        async with _request_slots:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                extra_body=extra_body,
+                stream=True,
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    except Exception as exc:
+        raise Exception(f"OpenAI API call failed: {exc}") from exc
+
+
 def build_system_prompt(products: list[dict]) -> str:
     product_lines = []
     for product in products:
@@ -64,13 +152,14 @@ def build_system_prompt(products: list[dict]) -> str:
     
     address_info = f"\n\nOur store address for pickup: {business_address}" if business_address else ""
     
+    # Static instructions go first and the catalog last, so the prompt prefix
+    # stays byte-identical across catalog changes and provider-side prompt
+    # caching can reuse it.
     system_prompt = f"""You are a customer service agent for {business_name}, a {business_kind}.
-You have the following products in your catalog:
-{catalog_text}{address_info}
 
 IMPORTANT INSTRUCTIONS:
 - ALWAYS respond in the SAME LANGUAGE that the customer is using. Detect their language and match it.
-- The prices shown are for HALF (1/2) of the product, NOT the full unit price. 
+- The prices shown in the catalog below are for HALF (1/2) of the product, NOT the full unit price. 
 - If customers ask about price that is not 1/2 unit, calculate accordingly.
 - Don't show the customer the process of calculation, just provide the final price.
 - Be helpful, polite, and provide accurate information about the products and prices.
@@ -79,27 +168,177 @@ ORDER COMPLETION PROCESS:
 - Once the customer confirms they don't want anything else, ask if they want delivery or pickup at the store.
 - If they want DELIVERY: ask for their delivery address.
 - If they want PICKUP at the store: use "{business_address}" as the address.
-- When the customer confirms they don't want anything else AND you have the address (delivery or pickup), respond ONLY with a JSON object in this exact format:
-{{
-  "products": [
-    {{"product": "product name", "quantity": quantity, "unit_price": unit_price}}
-  ],
-  "total_price": total_price,
-  "address": "customer address OR store address for pickup"
-}}
-
-When returning the JSON, return ONLY the JSON object, no additional text, no greetings, no explanations."""
+- When the customer confirms they don't want anything else AND you have the address (delivery or pickup), respond ONLY with the text {ORDER_READY_SIGNAL}, no additional text, no greetings, no explanations.
+
+You have the following products in your catalog:
+{catalog_text}{address_info}"""
     
     return system_prompt
 
 
-def chat_with_assistant(
-    user_message: str, products: list[dict], conversation_history: list[dict] = None
-) -> str:
-    system_prompt = build_system_prompt(products)
+async def finalize_order(messages: list[dict[str, str]]) -> str:
+    finalize_messages = messages + [
+        {
+            "role": "system",
+            "content": (
+                "Summarize the confirmed order. Use the half-unit catalog prices "
+                "for unit_price, and the delivery address or the store address "
+                "for pickup as address."
+            ),
+        }
+    ]
+    try:
+        async with _request_slots:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=finalize_messages,
+                temperature=0,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "order",
+                        "schema": ORDER_SCHEMA,
+                        "strict": True,
+                    },
+                },
+            )
+
+        return response.choices[0].message.content.strip()
+    except Exception as exc:
+        raise Exception(f"OpenAI API call failed: {exc}") from exc
+
+
+def parse_order(response: str) -> Optional[dict]:
+    if not response.startswith("{"):
+        return None
+    try:
+        order_data = orjson.loads(response)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(order_data, dict) or not order_data.keys() >= _ORDER_KEYS:
+        return None
+    if not isinstance(order_data["products"], list) or not all(
+        isinstance(item, dict) and item.keys() >= _ORDER_ITEM_KEYS
+        for item in order_data["products"]
+    ):
+        return None
+    return order_data
+
+
+def _is_cacheable(user_message: str, conversation_history: Optional[list[dict]]) -> bool:
+    # Only opening catalog questions are safe to share between customers;
+    # follow-up turns depend on the conversation, and digits usually mean
+    # quantities or an address that must not leak into someone else's reply.
+    return (
+        semantic_cache_enabled
+        and not conversation_history
+        and not any(char.isdigit() for char in user_message)
+    )
+
+
+async def _lookup_semantic_cache(
+    user_message: str, system_prompt: str, conversation_history: Optional[list[dict]]
+) -> tuple[Optional[str], Optional[np.ndarray], Optional[str]]:
+    if not _is_cacheable(user_message, conversation_history):
+        return None, None, None
+
+    scope = SemanticCache.scope_key(system_prompt)
+    try:
+        # The embeddings call counts against the same OpenAI concurrency cap.
+        async with _request_slots:
+            embedding = await semantic_cache.embed(user_message)
+    except Exception:
+        return None, None, None
+
+    hits = semantic_cache.similarity_search_limit_score(scope, embedding, k=1)
+    return scope, embedding, hits[0][0] if hits else None
+
+
+def _build_messages(
+    user_message: str, system_prompt: str, conversation_history: Optional[list[dict]]
+) -> list[dict[str, str]]:
     messages = [{"role": "system", "content": system_prompt}]
     if conversation_history:
         messages.extend(conversation_history)
 
     messages.append({"role": "user", "content": user_message})
-    return send_prompt_with_history(messages)
+    return messages
+
+
+async def chat_with_assistant(
+    user_message: str, system_prompt: str, conversation_history: list[dict] = None
+) -> str:
+    messages = _build_messages(user_message, system_prompt, conversation_history)
+
+    scope, embedding, cached = await _lookup_semantic_cache(
+        user_message, system_prompt, conversation_history
+    )
+    if cached is not None:
+        return cached
+
+    response = await send_prompt_with_history(messages, prompt_cache_key=prompt_cache_key)
+    if ORDER_READY_SIGNAL in response:
+        order_response = await finalize_order(messages)
+        if parse_order(order_response) is None:
+            logger.warning("Discarding unparseable order payload: %r", order_response)
+            return ORDER_FAILED_MESSAGE
+        return order_response
+
+    if scope is not None:
+        semantic_cache.set(scope, embedding, response)
+    return response
+
+
+async def stream_chat_with_assistant(
+    user_message: str, system_prompt: str, conversation_history: list[dict] = None
+) -> AsyncIterator[Union[str, dict]]:
+    # Yields text deltas, or a single parsed order dict when the turn closes an order.
+    messages = _build_messages(user_message, system_prompt, conversation_history)
+
+    scope, embedding, cached = await _lookup_semantic_cache(
+        user_message, system_prompt, conversation_history
+    )
+    if cached is not None:
+        yield cached
+        return
+
+    # Text streams as it arrives, except for a tail that could still be the
+    # start of ORDER_READY. As in chat_with_assistant, the signal anywhere in
+    # the reply closes the order, and the signal itself never reaches the
+    # customer or the cache.
+    text = ""
+    sent = 0
+    signalled = False
+    stream = stream_prompt_with_history(messages, prompt_cache_key=prompt_cache_key)
+    async with aclosing(stream):
+        async for delta in stream:
+            text += delta
+            if ORDER_READY_SIGNAL in text:
+                signalled = True
+                break
+            held = next(
+                (
+                    size
+                    for size in range(min(len(ORDER_READY_SIGNAL) - 1, len(text) - sent), 0, -1)
+                    if text.endswith(ORDER_READY_SIGNAL[:size])
+                ),
+                0,
+            )
+            if len(text) - held > sent:
+                yield text[sent:len(text) - held]
+                sent = len(text) - held
+
+    if signalled:
+        order_response = await finalize_order(messages)
+        order_data = parse_order(order_response)
+        if order_data is None:
+            logger.warning("Discarding unparseable order payload: %r", order_response)
+            yield ORDER_FAILED_MESSAGE
+        else:
+            yield order_data
+        return
+
+    if sent < len(text):
+        yield text[sent:]
+    if scope is not None:
+        semantic_cache.set(scope, embedding, text.strip())
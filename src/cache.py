@@ -0,0 +1,106 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from openai import AsyncOpenAI
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        embedding_model: str = "text-embedding-3-small",
+        score_threshold: float = 0.9,
+        ttl: float = 3600.0,
+        max_entries_per_scope: int = 512,
+        max_entries: int = 4096,
+    ):
+        self.client = client
+        self.embedding_model = embedding_model
+        self.score_threshold = score_threshold
+        self.ttl = ttl
+        self.max_entries_per_scope = max_entries_per_scope
+        self.max_entries = max_entries
+        self._scopes: dict[str, OrderedDict[int, tuple[np.ndarray, str, float]]] = {}
+        # Every live entry in insertion order, so expiry and the global cap
+        # can evict across scopes without scanning them all.
+        self._entries: OrderedDict[int, str] = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def scope_key(*parts: str) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    async def embed(self, text: str) -> np.ndarray:
+        response = await self.client.embeddings.create(
+            model=self.embedding_model,
+            input=text,
+        )
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def similarity_search_limit_score(
+        self, scope: str, embedding: np.ndarray, k: int = 1, score_threshold: Optional[float] = None
+    ) -> list[tuple[str, float]]:
+        entries = self._scopes.get(scope)
+        if not entries:
+            return []
+
+        now = time.monotonic()
+        for entry_id in [entry_id for entry_id, entry in entries.items() if entry[2] <= now]:
+            self._remove(scope, entry_id)
+        entries = self._scopes.get(scope)
+        if not entries:
+            return []
+
+        threshold = self.score_threshold if score_threshold is None else score_threshold
+        values = list(entries.values())
+        scores = np.stack([entry[0] for entry in values]) @ embedding
+        best = np.argsort(scores)[::-1][:k]
+        return [
+            (values[index][1], float(scores[index]))
+            for index in best
+            if scores[index] >= threshold
+        ]
+
+    def set(self, scope: str, embedding: np.ndarray, response: str, ttl: Optional[float] = None) -> None:
+        now = time.monotonic()
+        entries = self._scopes.setdefault(scope, OrderedDict())
+        entry_id = self._next_id
+        self._next_id += 1
+        entries[entry_id] = (
+            embedding,
+            response,
+            now + (self.ttl if ttl is None else ttl),
+        )
+        self._entries[entry_id] = scope
+        while len(entries) > self.max_entries_per_scope:
+            self._remove(scope, next(iter(entries)))
+        self._evict(now)
+
+    def _remove(self, scope: str, entry_id: int) -> None:
+        self._entries.pop(entry_id, None)
+        entries = self._scopes.get(scope)
+        if entries is None:
+            return
+        entries.pop(entry_id, None)
+        if not entries:
+            del self._scopes[scope]
+
+    def _evict(self, now: float) -> None:
+        while self._entries:
+            entry_id, scope = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and self._scopes[scope][entry_id][2] > now:
+                break
+            self._remove(scope, entry_id)
+
+    def clear(self) -> None:
+        self._scopes.clear()
+        self._entries.clear()
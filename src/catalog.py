@@ -0,0 +1,59 @@
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from ai import build_system_prompt
+from db import get_engine, products_table
+
+
+catalog_cache_ttl = float(os.getenv("CATALOG_CACHE_TTL", "60"))
+
+_SYSTEM_PROMPT_CACHE: Optional[str] = None
+_LOADED_AT = 0.0
+
+PRODUCTS_STMT = select(
+	products_table.c.name,
+	products_table.c.price_half_quantity,
+).order_by(products_table.c.id.asc())
+
+
+async def _load_catalog(connection: Optional[AsyncConnection] = None) -> None:
+	global _SYSTEM_PROMPT_CACHE, _LOADED_AT
+
+	if connection is not None:
+		result = await connection.execute(PRODUCTS_STMT)
+	else:
+		async with get_engine().connect() as own_connection:
+			result = await own_connection.execute(PRODUCTS_STMT)
+	rows = result.mappings().all()
+
+	products = [
+		{
+			"name": row["name"],
+			"price_half_quantity": row["price_half_quantity"],
+		}
+		for row in rows
+	]
+	_SYSTEM_PROMPT_CACHE = build_system_prompt(products)
+	_LOADED_AT = time.monotonic()
+
+
+def _is_stale() -> bool:
+	return (
+		_SYSTEM_PROMPT_CACHE is None
+		or time.monotonic() - _LOADED_AT >= catalog_cache_ttl
+	)
+
+
+async def get_cached_system_prompt(connection: Optional[AsyncConnection] = None) -> str:
+	if _is_stale():
+		await _load_catalog(connection)
+	return _SYSTEM_PROMPT_CACHE
+
+
+def invalidate_catalog() -> None:
+	global _SYSTEM_PROMPT_CACHE
+	_SYSTEM_PROMPT_CACHE = None
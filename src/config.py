@@ -0,0 +1,36 @@
+import functools
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    twilio_sid: Optional[str]
+    twilio_token: Optional[str]
+    twilio_from: Optional[str]
+    twilio_to: Optional[str]
+    mp_token: Optional[str]
+    test_card_number: Optional[str]
+    business_name: str = 'Mi Negocio'
+    mp_debug: bool = False
+
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    # Built once per process; the Twilio and Mercado Pago clients validate
+    # the fields they need, so a deployment without one of them still boots.
+    load_dotenv()
+    env = os.environ
+    return Settings(
+        twilio_sid=env.get('TWILIO_ACCOUNT_SID'),
+        twilio_token=env.get('TWILIO_AUTH_TOKEN'),
+        twilio_from=env.get('TWILIO_FROM_NUMBER'),
+        twilio_to=env.get('TWILIO_TO_NUMBER'),
+        mp_token=env.get('MP_ACCESS_TOKEN'),
+        test_card_number=env.get('TEST_CARD_NUMBER'),
+        business_name=env.get('BUSINESS_NAME', 'Mi Negocio'),
+        mp_debug=env.get('MP_DEBUG', 'false').lower() in ('1', 'true', 'yes'),
+    )
@@ -1,24 +1,25 @@
 # Using MariaDB with SQLAlchemy, but you can use any
 import os
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
 
 from dotenv import load_dotenv
 from sqlalchemy import (
 	Column,
 	DateTime,
 	Enum,
+	Index,
 	Integer,
 	MetaData,
 	Numeric,
 	String,
 	Table,
 	Text,
-	create_engine,
 	text,
 )
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Connection
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
 from sqlalchemy.sql import func
 
 
@@ -28,6 +29,9 @@ db_user = os.getenv("DB_USER")
 db_password = os.getenv("DB_PASSWORD")
 db_host = os.getenv("DB_HOST")
 db_name = os.getenv("DB_NAME")
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "20"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
 
 missing = [
 	name
@@ -66,59 +70,116 @@ conversations_table = Table(
 	Column("created_at", DateTime, nullable=False, server_default=func.now()),
 )
 
+orders_table = Table(
+	"orders",
+	metadata,
+	Column("id", Integer, primary_key=True, autoincrement=True),
+	Column("user_id", String(255), nullable=False),
+	Column("total_price", Numeric(10, 2), nullable=False),
+	Column("address", Text, nullable=False),
+	Column("created_at", DateTime, nullable=False, server_default=func.now()),
+)
 
-_engine: Optional[Engine] = None
-SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+Index(
+	"ix_conv_user_created",
+	conversations_table.c.user_id,
+	conversations_table.c.created_at.desc(),
+)
 
 
-def _ensure_products_table_schema(engine: Engine) -> None:
-	with engine.begin() as connection:
-		try:
-			result = connection.execute(text("SHOW TABLES LIKE 'products'"))
-			if result.first() is None:
-				return
-			columns_result = connection.execute(text("SHOW COLUMNS FROM products"))
-			columns = {row["Field"] for row in columns_result.mappings()}
-			if "quantity_half_units" in columns:
-				connection.execute(
-					text("ALTER TABLE products DROP COLUMN quantity_half_units")
+_engine: Optional[AsyncEngine] = None
+
+
+def _ensure_products_table_schema(connection: Connection) -> None:
+	try:
+		result = connection.execute(text("SHOW TABLES LIKE 'products'"))
+		if result.first() is None:
+			return
+		columns_result = connection.execute(text("SHOW COLUMNS FROM products"))
+		columns = {row["Field"] for row in columns_result.mappings()}
+		if "quantity_half_units" in columns:
+			connection.execute(
+				text("ALTER TABLE products DROP COLUMN quantity_half_units")
+			)
+			columns.remove("quantity_half_units")
+		if "price" in columns and "price_half_quantity" not in columns:
+			connection.execute(
+				text(
+					"ALTER TABLE products CHANGE COLUMN price "
+					"price_half_quantity DECIMAL(10,2) NOT NULL"
 				)
-				columns.remove("quantity_half_units")
-			if "price" in columns and "price_half_quantity" not in columns:
-				connection.execute(
-					text(
-						"ALTER TABLE products CHANGE COLUMN price "
-						"price_half_quantity DECIMAL(10,2) NOT NULL"
-					)
+			)
+	except SQLAlchemyError:
+		pass
+
+
+def _ensure_conversations_indexes(connection: Connection) -> None:
+	# create_all skips indexes on tables that already exist, so databases
+	# created before ix_conv_user_created need it added here.
+	try:
+		result = connection.execute(text("SHOW TABLES LIKE 'conversations'"))
+		if result.first() is None:
+			return
+		result = connection.execute(
+			text(
+				"SELECT 1 FROM information_schema.statistics "
+				"WHERE table_schema = DATABASE() "
+				"AND table_name = 'conversations' "
+				"AND index_name = 'ix_conv_user_created' "
+				"LIMIT 1"
+			)
+		)
+		if result.first() is None:
+			connection.execute(
+				text(
+					"CREATE INDEX ix_conv_user_created "
+					"ON conversations (user_id, created_at DESC)"
 				)
-		except SQLAlchemyError:
-			pass
+			)
+	except SQLAlchemyError:
+		pass
 
 
-def ensure_database_exists() -> None:
-	server_url = f"mysql+pymysql://{db_user}:{db_password}@{db_host}/"
-	server_engine = create_engine(server_url, isolation_level="AUTOCOMMIT")
+async def ensure_database_exists() -> None:
+	server_url = f"mysql+asyncmy://{db_user}:{db_password}@{db_host}/"
+	server_engine = create_async_engine(server_url, isolation_level="AUTOCOMMIT")
 
 	safe_db_name = db_name.replace("`", "``")
-	with server_engine.connect() as connection:
-		connection.execute(text(f"CREATE DATABASE IF NOT EXISTS `{safe_db_name}`"))
+	async with server_engine.connect() as connection:
+		await connection.execute(text(f"CREATE DATABASE IF NOT EXISTS `{safe_db_name}`"))
 
-	server_engine.dispose()
+	await server_engine.dispose()
 
 
-def get_engine() -> Engine:
+def get_engine() -> AsyncEngine:
 	global _engine
 	if _engine is None:
-		ensure_database_exists()
-		engine_url = f"mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}"
-		_engine = create_engine(engine_url, pool_pre_ping=True)
-		metadata.create_all(_engine)
-		SessionLocal.configure(bind=_engine)
-		_ensure_products_table_schema(_engine)
+		engine_url = f"mysql+asyncmy://{db_user}:{db_password}@{db_host}/{db_name}"
+		# pool_recycle must stay below the server's wait_timeout; that keeps
+		# pooled connections fresh without a pre-ping round-trip per checkout.
+		_engine = create_async_engine(
+			engine_url,
+			pool_size=db_pool_size,
+			max_overflow=db_max_overflow,
+			pool_recycle=db_pool_recycle,
+			pool_pre_ping=False,
+		)
 	return _engine
 
 
-def get_session() -> Session:
-	get_engine()
-	return SessionLocal()
+async def init_db() -> None:
+	await ensure_database_exists()
+	async with get_engine().begin() as connection:
+		await connection.run_sync(metadata.create_all)
+
+
+async def run_migrations() -> None:
+	async with get_engine().begin() as connection:
+		await connection.run_sync(_ensure_products_table_schema)
+		await connection.run_sync(_ensure_conversations_indexes)
+
 
+@asynccontextmanager
+async def tx() -> AsyncIterator[AsyncConnection]:
+	async with get_engine().begin() as connection:
+		yield connection
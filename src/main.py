@@ -1,34 +1,82 @@
+import asyncio
+import atexit
+import logging
 import os
-import json
+import gzip
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from decimal import Decimal
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from queue import Queue
+from typing import Any, AsyncIterator
 
-from fastapi import FastAPI, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, Response
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Form
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
-from sqlalchemy import delete, insert, select, update
+from sqlalchemy import bindparam, delete, insert, select, update
 from sqlalchemy.exc import SQLAlchemyError
 
-from ai import chat_with_assistant
+from ai import chat_with_assistant, parse_order, stream_chat_with_assistant
+from catalog import get_cached_system_prompt, invalidate_catalog
 from db import (
 		conversations_table,
-		ensure_database_exists,
 		get_engine,
-		get_session,
+		init_db,
+		orders_table,
 		products_table,
+		run_migrations,
+		tx,
 )
-from message import get_messenger
-from payment import create_payment_link, create_order_payment_link
+from message import close_http_session, get_messenger
+from payment import close_mp_client, create_payment_link, create_order_payment_link
+
+
+_log_queue: Queue = Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(handlers=[QueueHandler(_log_queue)], level=logging.INFO)
+
+log = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-	ensure_database_exists()
-	get_engine()
+	# Blocking Twilio/Mercado Pago SDK calls run via asyncio.to_thread; the
+	# default pool (min(32, cpu + 4) workers) would cap their concurrency.
+	executor = ThreadPoolExecutor(max_workers=SDK_THREAD_POOL_SIZE)
+	asyncio.get_running_loop().set_default_executor(executor)
+	await init_db()
+	if RUN_MIGRATIONS:
+		await run_migrations()
 	yield
+	await close_http_session()
+	await close_mp_client()
+	await get_engine().dispose()
+	executor.shutdown(wait=False)
+
+def _orjson_default(value: Any) -> Any:
+	if isinstance(value, Decimal):
+		return float(value)
+	raise TypeError
+
+
+class ORJSONDecimalResponse(JSONResponse):
+	# orjson rendering without FastAPI's deprecated ORJSONResponse; Decimal
+	# prices are written as JSON numbers.
+
+	def render(self, content: Any) -> bytes:
+		return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
 
-app = FastAPI(title="Orderflow Service", lifespan=lifespan)
+
+app = FastAPI(
+	title="Orderflow Service",
+	lifespan=lifespan,
+	default_response_class=ORJSONDecimalResponse,
+)
 
 class ProductPayload(BaseModel):
 	name: str = Field(..., min_length=1, max_length=255)
@@ -72,67 +120,113 @@ except FileNotFoundError as exc:
 	) from exc
 
 
+def _prepare_static_page(html: str) -> dict:
+	body = html.encode("utf-8")
+	digest = hashlib.md5(body).hexdigest()
+	# Strong validators must differ per content-coding.
+	return {
+		"body": body,
+		"etag": f'"{digest}"',
+		"gzip_body": gzip.compress(body, 9),
+		"gzip_etag": f'"{digest}-gzip"',
+	}
+
+
+CRUD_PAGE = _prepare_static_page(CRUD_HTML)
+CHAT_PAGE = _prepare_static_page(CHAT_HTML)
+
+
+def _serve_static_page(request: Request, page: dict) -> Response:
+	use_gzip = "gzip" in request.headers.get("accept-encoding", "")
+	etag = page["gzip_etag"] if use_gzip else page["etag"]
+	headers = {
+		"ETag": etag,
+		"Cache-Control": "public, max-age=300",
+		"Vary": "Accept-Encoding",
+	}
+	if request.headers.get("if-none-match") == etag:
+		return Response(status_code=304, headers=headers)
+
+	if use_gzip:
+		headers["Content-Encoding"] = "gzip"
+		return Response(page["gzip_body"], media_type="text/html", headers=headers)
+	return Response(page["body"], media_type="text/html", headers=headers)
+
+
+_recent_history = (
+	select(
+		conversations_table.c.id,
+		conversations_table.c.role,
+		conversations_table.c.content,
+		conversations_table.c.created_at,
+	)
+	.where(conversations_table.c.user_id == bindparam("uid"))
+	.order_by(
+		conversations_table.c.created_at.desc(),
+		conversations_table.c.id.desc(),
+	)
+	.limit(10)
+	.subquery()
+)
+HISTORY_STMT = select(
+	_recent_history.c.role,
+	_recent_history.c.content,
+).order_by(
+	_recent_history.c.created_at.asc(),
+	_recent_history.c.id.asc(),
+)
+INSERT_CONV_STMT = insert(conversations_table)
+
+
 APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
 APP_PORT = int(os.getenv("APP_PORT", "8000"))
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "0") == "1"
+SDK_THREAD_POOL_SIZE = int(os.getenv("SDK_THREAD_POOL_SIZE", "64"))
 
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root() -> str:
-		return CRUD_HTML
+async def read_root(request: Request) -> Response:
+		return _serve_static_page(request, CRUD_PAGE)
 
 @app.get("/chat", response_class=HTMLResponse)
-async def chat_page() -> str:
-		return CHAT_HTML
+async def chat_page(request: Request) -> Response:
+		return _serve_static_page(request, CHAT_PAGE)
 
 
 @app.post("/products")
 async def create_product(payload: ProductPayload) -> dict:
-		session = get_session()
 		try:
 				statement = insert(products_table).values(
 						name=payload.name,
 						price_half_quantity=payload.price_half_quantity,
 				)
-				session.execute(statement)
-				session.commit()
+				async with tx() as connection:
+						await connection.execute(statement)
 		except SQLAlchemyError as exc:
-				session.rollback()
 				raise HTTPException(
 						status_code=500, detail="Could not save the product"
 				) from exc
-		finally:
-				session.close()
+		invalidate_catalog()
 
 		return {"status": "ok"}
 
 
 @app.get("/products")
-async def list_products() -> dict:
-	session = get_session()
-	try:
-		statement = select(
-			products_table.c.id,
-			products_table.c.name,
-			products_table.c.price_half_quantity,
-		).order_by(products_table.c.id.desc())
-		rows = session.execute(statement).mappings().all()
-		products = [
-			{
-				"id": row["id"],
-				"name": row["name"],
-				"price_half_quantity": float(row["price_half_quantity"]),
-			}
-			for row in rows
-		]
-	finally:
-		session.close()
-
-	return {"items": products}
+async def list_products() -> Response:
+	statement = select(
+		products_table.c.id,
+		products_table.c.name,
+		products_table.c.price_half_quantity,
+	).order_by(products_table.c.id.desc())
+	async with get_engine().connect() as connection:
+		rows = (await connection.execute(statement)).mappings().all()
+	# Returned as a response so the rows skip Pydantic, which would turn the
+	# Decimal prices into strings; _orjson_default writes them as numbers.
+	return ORJSONDecimalResponse({"items": [dict(row) for row in rows]})
 
 
 @app.put("/products/{product_id}")
 async def update_product(product_id: int, payload: ProductPayload) -> dict:
-	session = get_session()
 	try:
 		statement = (
 			update(products_table)
@@ -142,185 +236,167 @@ async def update_product(product_id: int, payload: ProductPayload) -> dict:
 				price_half_quantity=payload.price_half_quantity,
 			)
 		)
-		result = session.execute(statement)
-		session.commit()
-		
-		if result.rowcount == 0:
-			raise HTTPException(status_code=404, detail="Product not found")
+		async with tx() as connection:
+			result = await connection.execute(statement)
 	except SQLAlchemyError as exc:
-		session.rollback()
 		raise HTTPException(
 			status_code=500, detail="Could not update the product"
 		) from exc
-	finally:
-		session.close()
+	invalidate_catalog()
+	
+	if result.rowcount == 0:
+		raise HTTPException(status_code=404, detail="Product not found")
 
 	return {"status": "ok"}
 
 
 @app.delete("/products/{product_id}")
 async def delete_product(product_id: int) -> dict:
-	session = get_session()
 	try:
 		statement = delete(products_table).where(products_table.c.id == product_id)
-		result = session.execute(statement)
-		session.commit()
-		
-		if result.rowcount == 0:
-			raise HTTPException(status_code=404, detail="Product not found")
+		async with tx() as connection:
+			result = await connection.execute(statement)
 	except SQLAlchemyError as exc:
-		session.rollback()
 		raise HTTPException(
 			status_code=500, detail="Could not delete the product"
 		) from exc
-	finally:
-		session.close()
+	invalidate_catalog()
+	
+	if result.rowcount == 0:
+		raise HTTPException(status_code=404, detail="Product not found")
 
 	return {"status": "ok"}
 
 
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest) -> dict:
-	user_id = "4"  # It must be a PK(user, date), in order to just take the currect conversation
-	
-	session = get_session()
-	try:
-		products_statement = select(
-			products_table.c.name,
-			products_table.c.price_half_quantity,
+async def _create_order(user_id: str, order_data: dict) -> int:
+	async with tx() as connection:
+		result = await connection.execute(
+			insert(orders_table).values(
+				user_id=user_id,
+				total_price=order_data['total_price'],
+				address=order_data['address'],
+			)
 		)
-		products_rows = session.execute(products_statement).mappings().all()
-		products = [
+	return result.inserted_primary_key[0]
+
+
+async def _web_order_reply(user_id: str, order_data: dict) -> str:
+	log.info("Order detected from web chat! Creating payment link...")
+	
+	payment_result = await create_order_payment_link(
+		order_id=await _create_order(user_id, order_data),
+		items=[
 			{
-				"name": row["name"],
-				"price_half_quantity": float(row["price_half_quantity"]),
+				'name': item['product'],
+				'price': item['unit_price'],
+				'quantity': item['quantity']
 			}
-			for row in products_rows
-		]
+			for item in order_data['products']
+		],
+		customer_name=f"Cliente Web {user_id}"
+	)
+	
+	if not payment_result['success']:
+		return "Sorry, there was an error creating the payment link. Please try again."
+	
+	products_lines = []
+	for item in order_data['products']:
+		item_total = item['unit_price'] * item['quantity']
+		products_lines.append(f"- {item['product']} x{item['quantity']} - ${item_total:.2f}")
+	
+	products_list = "\n".join(products_lines)
+	
+	store_address = os.getenv("ADDRESS", "")
+	is_pickup = (store_address and order_data['address'] == store_address)
+	delivery_text = "Store Pickup:" if is_pickup else "Delivery Address:"
+	
+	return (
+		"Order Confirmed!\n\n"
+		"Order Summary:\n"
+		f"{products_list}\n\n"
+		f"Total: ${order_data['total_price']:.2f}\n"
+		f"{delivery_text} {order_data['address']}\n\n"
+		"To complete your purchase, make the payment here:\n"
+		f"{payment_result['payment_link']}\n\n"
+		"Once payment is completed, we will process your order immediately. Thank you for your purchase!"
+	)
+
+
+def _sse(payload: dict) -> str:
+	return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
+async def _stream_chat(
+	user_id: str,
+	user_message: str,
+	system_prompt: str,
+	conversation_history: list[dict],
+) -> AsyncIterator[str]:
+	user_row = {"user_id": user_id, "role": "user", "content": user_message}
+	persisted = False
+	try:
+		deltas = []
+		order_reply = None
+		async for chunk in stream_chat_with_assistant(user_message, system_prompt, conversation_history):
+			if isinstance(chunk, dict):
+				order_reply = await _web_order_reply(user_id, chunk)
+				# Text streamed before the order signal stays on screen; only
+				# the confirmation is stored as the assistant turn.
+				yield _sse({"delta": f"\n\n{order_reply}" if deltas else order_reply})
+			else:
+				deltas.append(chunk)
+				yield _sse({"delta": chunk})
 		
-		history_statement = (
-			select(
-				conversations_table.c.role,
-				conversations_table.c.content,
+		response = order_reply if order_reply is not None else "".join(deltas).strip()
+		async with tx() as connection:
+			await connection.execute(
+				INSERT_CONV_STMT,
+				[user_row, {"user_id": user_id, "role": "assistant", "content": response}],
 			)
-			.where(conversations_table.c.user_id == user_id)
-			.order_by(conversations_table.c.created_at.desc())
-			.limit(10)
-		)
-		history_rows = session.execute(history_statement).mappings().all()
-		conversation_history = [
-			{"role": row["role"], "content": row["content"]}
-			for row in reversed(list(history_rows))
-		]
+		persisted = True
 		
-		user_insert = insert(conversations_table).values(
-			user_id=user_id,
-			role="user",
-			content=request.message,
-		)
-		session.execute(user_insert)
-		session.commit()
+		yield _sse({"done": True})
 		
-	except SQLAlchemyError as exc:
-		session.rollback()
-		session.close()
-		raise HTTPException(
-			status_code=500, detail="Database error"
-		) from exc
+	except Exception as exc:
+		yield _sse({"error": f"AI service error: {str(exc)}"})
+	
+	finally:
+		# A failed or abandoned stream still records the user's turn, so the
+		# next request keeps the conversation context.
+		if not persisted:
+			try:
+				async with tx() as connection:
+					await connection.execute(INSERT_CONV_STMT, [user_row])
+			except SQLAlchemyError:
+				log.exception("Could not save the chat message for %s", user_id)
+
+
+@app.post("/chat")
+async def chat_endpoint(request: ChatRequest) -> StreamingResponse:
+	user_id = "4"  # It must be a PK(user, date), in order to just take the currect conversation
 	
 	try:
-		response = chat_with_assistant(request.message, products, conversation_history)
+		async with get_engine().connect() as connection:
+			system_prompt = await get_cached_system_prompt(connection)
+			history_result = await connection.execute(HISTORY_STMT, {"uid": user_id})
+		# HISTORY_STMT already returns (role, content) oldest-first.
+		conversation_history = [dict(row) for row in history_result.mappings()]
 		
-		try:
-			order_data = json.loads(response)
-			
-			if all(key in order_data for key in ['products', 'total_price', 'address']):
-				print(f"Order detected from web chat! Creating payment link...")
-				
-				payment_result = create_order_payment_link(
-					order_id=hash(user_id) % 1000000,
-					items=[
-						{
-							'name': item['product'],
-							'price': item['unit_price'],
-							'quantity': item['quantity']
-						}
-						for item in order_data['products']
-					],
-					customer_name=f"Cliente Web {user_id}"
-				)
-				
-				if payment_result['success']:
-					products_lines = []
-					for item in order_data['products']:
-						item_total = item['unit_price'] * item['quantity']
-						products_lines.append(f"- {item['product']} x{item['quantity']} - ${item_total:.2f}")
-					
-					products_list = "\n".join(products_lines)
-					
-					store_address = os.getenv("ADDRESS", "")
-					is_pickup = (store_address and order_data['address'] == store_address)
-					delivery_text = "Store Pickup:" if is_pickup else "Delivery Address:"
-					
-					customer_message = (
-						"Order Confirmed!\n\n"
-						"Order Summary:\n"
-						f"{products_list}\n\n"
-						f"Total: ${order_data['total_price']:.2f}\n"
-						f"{delivery_text} {order_data['address']}\n\n"
-						"To complete your purchase, make the payment here:\n"
-						f"{payment_result['payment_link']}\n\n"
-						"Once payment is completed, we will process your order immediately. Thank you for your purchase!"
-					)
-					
-					assistant_insert = insert(conversations_table).values(
-						user_id=user_id,
-						role="assistant",
-						content=customer_message,
-					)
-					session.execute(assistant_insert)
-					session.commit()
-					
-					return {"response": customer_message}
-				else:
-					error_message = "Sorry, there was an error creating the payment link. Please try again."
-					
-					assistant_insert = insert(conversations_table).values(
-						user_id=user_id,
-						role="assistant",
-						content=error_message,
-					)
-					session.execute(assistant_insert)
-					session.commit()
-					
-					return {"response": error_message}
-					
-		except (json.JSONDecodeError, KeyError):
-			pass
-		
-		assistant_insert = insert(conversations_table).values(
-			user_id=user_id,
-			role="assistant",
-			content=response,
-		)
-		session.execute(assistant_insert)
-		session.commit()
-		
-		return {"response": response}
-		
-	except Exception as exc:
-		session.rollback()
+	except SQLAlchemyError as exc:
 		raise HTTPException(
-			status_code=500, detail=f"AI service error: {str(exc)}"
+			status_code=500, detail="Database error"
 		) from exc
-	finally:
-		session.close()
+	
+	return StreamingResponse(
+		_stream_chat(user_id, request.message, system_prompt, conversation_history),
+		media_type="text/event-stream",
+	)
 
 
 @app.post("/payment/create-link")
 async def create_payment_link_endpoint(payload: PaymentLinkRequest) -> dict:
 	try:
-		result = create_payment_link(
+		result = await create_payment_link(
 			title=payload.title,
 			amount=payload.amount,
 			description=payload.description,
@@ -346,7 +422,7 @@ async def create_payment_link_endpoint(payload: PaymentLinkRequest) -> dict:
 @app.post("/payment/create-order-link")
 async def create_order_payment_link_endpoint(payload: OrderPaymentRequest) -> dict:
 	try:
-		result = create_order_payment_link(
+		result = await create_order_payment_link(
 			order_id=payload.order_id,
 			items=payload.items,
 			customer_name=payload.customer_name
@@ -367,186 +443,134 @@ async def create_order_payment_link_endpoint(payload: OrderPaymentRequest) -> di
 		) from exc
 
 
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+
 @app.post("/webhook/whatsapp")
 async def whatsapp_webhook(
 	request: Request,
+	background_tasks: BackgroundTasks,
 	From: str = Form(...),
 	Body: str = Form(...),
 	MessageSid: str = Form(None)
 ) -> Response:
 	user_phone = From.replace("whatsapp:", "")
-	user_message = Body
+	background_tasks.add_task(_process_whatsapp_message, user_phone, Body)
 
-	session = get_session()
+	return Response(content=EMPTY_TWIML, media_type="application/xml")
+
+
+async def _process_whatsapp_message(user_phone: str, user_message: str) -> None:
 	try:
+		messenger = get_messenger()
 		user_id = user_phone
 		
-		products_statement = select(
-			products_table.c.name,
-			products_table.c.price_half_quantity,
-		)
-		products_rows = session.execute(products_statement).mappings().all()
-		products = [
-			{
-				"name": row["name"],
-				"price_half_quantity": float(row["price_half_quantity"]),
-			}
-			for row in products_rows
-		]
+		async with get_engine().connect() as connection:
+			system_prompt = await get_cached_system_prompt(connection)
+			history_result = await connection.execute(HISTORY_STMT, {"uid": user_id})
+		# HISTORY_STMT already returns (role, content) oldest-first.
+		conversation_history = [dict(row) for row in history_result.mappings()]
 		
-		history_statement = (
-			select(
-				conversations_table.c.role,
-				conversations_table.c.content,
-			)
-			.where(conversations_table.c.user_id == user_id)
-			.order_by(conversations_table.c.created_at.desc())
-			.limit(10)
-		)
-		history_rows = session.execute(history_statement).mappings().all()
-		conversation_history = [
-			{"role": row["role"], "content": row["content"]}
-			for row in reversed(list(history_rows))
-		]
+		ai_response = await chat_with_assistant(user_message, system_prompt, conversation_history)
+		user_row = {"user_id": user_id, "role": "user", "content": user_message}
 		
-		user_insert = insert(conversations_table).values(
-			user_id=user_id,
-			role="user",
-			content=user_message,
-		)
-		session.execute(user_insert)
-		session.commit()
-		
-		ai_response = chat_with_assistant(user_message, products, conversation_history)
-		
-		try:
-			order_data = json.loads(ai_response)
+		order_data = parse_order(ai_response)
+		if order_data is not None:
+			log.info("Order detected! Creating payment link...")
 			
-			if all(key in order_data for key in ['products', 'total_price', 'address']):
-				print(f"Order detected! Creating payment link...")
+			payment_result = await create_order_payment_link(
+				order_id=await _create_order(user_id, order_data),
+				items=[
+					{
+						'name': item['product'],
+						'price': item['unit_price'],
+						'quantity': item['quantity']
+					}
+					for item in order_data['products']
+				],
+				customer_name=f"Cliente {user_phone[-4:]}"
+			)
+			
+			if payment_result['success']:
+				products_lines = []
+				for item in order_data['products']:
+					item_total = item['unit_price'] * item['quantity']
+					products_lines.append(f"- {item['product']} x{item['quantity']} - ${item_total:.2f}")
+				
+				products_list = "\n".join(products_lines)
+				
+				store_address = os.getenv("ADDRESS", "")
+				is_pickup = (store_address and order_data['address'] == store_address)
+				delivery_text = "*Store Pickup:*" if is_pickup else "*Delivery Address:*"
 				
-				payment_result = create_order_payment_link(
-					order_id=hash(user_phone) % 1000000,
-					items=[
-						{
-							'name': item['product'],
-							'price': item['unit_price'],
-							'quantity': item['quantity']
-						}
-						for item in order_data['products']
-					],
-					customer_name=f"Cliente {user_phone[-4:]}"
+				customer_message = (
+					"*Order Confirmed!*\n\n"
+					"*Order Summary:*\n"
+					f"{products_list}\n\n"
+					f"*Total: ${order_data['total_price']:.2f}*\n"
+					f"{delivery_text} {order_data['address']}\n\n"
+					"*To complete your purchase, make the payment here:*\n"
+					f"{payment_result['payment_link']}\n\n"
+					"Once payment is completed, we will process your order immediately. Thank you for your purchase!"
 				)
 				
-				if payment_result['success']:
-					products_lines = []
-					for item in order_data['products']:
-						item_total = item['unit_price'] * item['quantity']
-						products_lines.append(f"- {item['product']} x{item['quantity']} - ${item_total:.2f}")
-					
-					products_list = "\n".join(products_lines)
-					
-					store_address = os.getenv("ADDRESS", "")
-					is_pickup = (store_address and order_data['address'] == store_address)
-					delivery_text = "*Store Pickup:*" if is_pickup else "*Delivery Address:*"
-					
-					customer_message = (
-						"*Order Confirmed!*\n\n"
-						"*Order Summary:*\n"
-						f"{products_list}\n\n"
-						f"*Total: ${order_data['total_price']:.2f}*\n"
-						f"{delivery_text} {order_data['address']}\n\n"
-						"*To complete your purchase, make the payment here:*\n"
-						f"{payment_result['payment_link']}\n\n"
-						"Once payment is completed, we will process your order immediately. Thank you for your purchase!"
+				async with tx() as connection:
+					await connection.execute(
+						INSERT_CONV_STMT,
+						[user_row, {"user_id": user_id, "role": "assistant", "content": customer_message}],
 					)
-					
-					assistant_insert = insert(conversations_table).values(
-						user_id=user_id,
-						role="assistant",
-						content=customer_message,
-					)
-					session.execute(assistant_insert)
-					session.commit()
-					
-					messenger = get_messenger()
-					send_result = messenger.send_message(
-						body=customer_message,
-						to_number=user_phone
-					)
-					
-					if send_result['success']:
-						print(f"Payment link sent to {user_phone}")
-					else:
-						print(f"Failed to send payment link: {send_result.get('error')}")
+				
+				send_result = await messenger.send_message(
+					body=customer_message,
+					to_number=user_phone
+				)
+				
+				if send_result['success']:
+					log.info("Payment link sent to %s", user_phone)
 				else:
-					error_message = "Sorry, there was an error creating the payment link. Please try again."
-					
-					assistant_insert = insert(conversations_table).values(
-						user_id=user_id,
-						role="assistant",
-						content=error_message,
-					)
-					session.execute(assistant_insert)
-					session.commit()
-					
-					messenger = get_messenger()
-					messenger.send_message(
-						body=error_message,
-						to_number=user_phone
+					log.warning("Failed to send payment link: %s", send_result.get('error'))
+			else:
+				error_message = "Sorry, there was an error creating the payment link. Please try again."
+				
+				async with tx() as connection:
+					await connection.execute(
+						INSERT_CONV_STMT,
+						[user_row, {"user_id": user_id, "role": "assistant", "content": error_message}],
 					)
 				
-				return Response(
-					content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>',
-					media_type="application/xml"
+				await messenger.send_message(
+					body=error_message,
+					to_number=user_phone
 				)
-				
-		except (json.JSONDecodeError, KeyError):
-			pass
+			
+			return
 		
-		assistant_insert = insert(conversations_table).values(
-			user_id=user_id,
-			role="assistant",
-			content=ai_response,
-		)
-		session.execute(assistant_insert)
-		session.commit()
+		async with tx() as connection:
+			await connection.execute(
+				INSERT_CONV_STMT,
+				[user_row, {"user_id": user_id, "role": "assistant", "content": ai_response}],
+			)
 		
-		messenger = get_messenger()
-		send_result = messenger.send_message(
+		send_result = await messenger.send_message(
 			body=ai_response,
 			to_number=user_phone
 		)
 		
 		if send_result['success']:
-			print(f"Response sent to {user_phone}")
+			log.info("Response sent to %s", user_phone)
 		else:
-			print(f"Failed to send response: {send_result.get('error')}")
+			log.warning("Failed to send response: %s", send_result.get('error'))
 		
-		return Response(
-			content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>',
-			media_type="application/xml"
-		)
-		
-	except Exception as exc:
-		session.rollback()
-		print(f"Error processing WhatsApp message: {str(exc)}")
+	except Exception:
+		log.exception("Error processing WhatsApp message from %s", user_phone)
 		
 		try:
-			messenger = get_messenger()
-			messenger.send_message(
+			await get_messenger().send_message(
 				body="Sorry, there was an error processing your message. Please try again.",
 				to_number=user_phone
 			)
 		except:
 			pass
-		
-		return Response(
-			content='<?xml version="1.0" encoding="UTF-8"?><Response></Response>',
-			media_type="application/xml"
-		)
-	finally:
-		session.close()
 
 
 if __name__ == "__main__":
@@ -1,28 +1,102 @@
-import os
+import asyncio
+import threading
+import time
 from typing import Optional
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioRestException
-from dotenv import load_dotenv
 
-load_dotenv()
+import aiohttp
+
+from config import get_settings
+from retry import RETRY_MAX_ATTEMPTS, backoff_delay
+
+TO_CACHE_MAX_SIZE = 1024
+# Twilio rejects the request outright on 429/503; other 5xx may have sent it.
+RETRY_STATUSES = frozenset({429, 503})
+STATUS_CACHE_TTL = 2.0
+STATUS_CACHE_MAX_SIZE = 10_000
+TERMINAL_MESSAGE_STATUSES = frozenset({'failed', 'undelivered', 'read'})
+TWILIO_MESSAGES_URL = "https://api.twilio.com/2010-04-01/Accounts/{sid}/Messages.json"
+
+MISSING_TWILIO_CREDENTIALS = (
+    "Missing Twilio credentials. Please check your .env file for "
+    "TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, and TWILIO_FROM_NUMBER"
+)
+
+_ORDER_TMPL = (
+    "*New Order - #{order_id}*\n\n"
+    "Customer: {customer_name}\n\n"
+    "Order details:\n{order_details}\n\n"
+    "Please confirm receipt of this order!"
+)
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75)
+        )
+    return _http_session
+
+
+async def close_http_session() -> None:
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def _build_twilio_client(account_sid: str, auth_token: str):
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+    from urllib3.util.retry import Retry
+    
+    # TwilioHttpClient already keeps one requests.Session for its lifetime;
+    # only its connection pool and retry policy are tuned here.
+    http_client = TwilioHttpClient()
+    http_client.session.mount('https://', HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=64,
+        pool_block=False,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+    ))
+    return Client(account_sid, auth_token, http_client=http_client)
 
 
 class WhatsAppMessenger:
     def __init__(self):
-        self.account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-        self.auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-        self.from_number = os.getenv('TWILIO_FROM_NUMBER')
-        self.to_number = os.getenv('TWILIO_TO_NUMBER')
+        settings = get_settings()
+        self.account_sid = settings.twilio_sid
+        self.auth_token = settings.twilio_token
+        self.from_number = settings.twilio_from
+        self.to_number = settings.twilio_to
         
-        if not all([self.account_sid, self.auth_token, self.from_number]):
-            raise ValueError(
-                "Missing Twilio credentials. Please check your .env file for "
-                "TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, and TWILIO_FROM_NUMBER"
-            )
+        if not (self.account_sid and self.auth_token and self.from_number):
+            raise ValueError(MISSING_TWILIO_CREDENTIALS)
         
-        self.client = Client(self.account_sid, self.auth_token)
+        self._client = None
+        self._from_whatsapp = f"whatsapp:{self.from_number}"
+        self._to_whatsapp_default = f"whatsapp:{self.to_number}" if self.to_number else None
+        self._to_cache: dict[str, str] = {}
+        self._status_cache: dict[str, tuple[float, dict]] = {}
+        self.auth = aiohttp.BasicAuth(self.account_sid, self.auth_token)
+        self.messages_url = TWILIO_MESSAGES_URL.format(sid=self.account_sid)
     
-    def send_message(
+    @property
+    def client(self):
+        # The Twilio SDK (and requests) is only needed for status lookups,
+        # so it is built on first use.
+        if self._client is None:
+            self._client = _build_twilio_client(self.account_sid, self.auth_token)
+        return self._client
+    
+    async def send_message(
         self, 
         body: str, 
         to_number: Optional[str] = None,
@@ -33,45 +107,93 @@ class WhatsAppMessenger:
         if not recipient:
             raise ValueError("No recipient number provided")
         
-        from_whatsapp = f"whatsapp:{self.from_number}"
-        to_whatsapp = f"whatsapp:{recipient}"
+        if recipient is self.to_number:
+            to_whatsapp = self._to_whatsapp_default
+        else:
+            to_whatsapp = self._to_cache.get(recipient)
+            if to_whatsapp is None:
+                if len(self._to_cache) >= TO_CACHE_MAX_SIZE:
+                    self._to_cache.clear()
+                to_whatsapp = self._to_cache[recipient] = f"whatsapp:{recipient}"
         
-        try:
-            message_params = {
-                'from_': from_whatsapp,
-                'body': body,
-                'to': to_whatsapp
-            }
-            
-            if media_url:
-                message_params['media_url'] = [media_url]
-            
-            message = self.client.messages.create(**message_params)
-            
-            return {
-                'success': True,
-                'message_sid': message.sid,
-                'status': message.status,
-                'to': recipient,
-                'from': self.from_number
-            }
-            
-        except TwilioRestException as e:
+        data = {
+            'From': self._from_whatsapp,
+            'To': to_whatsapp,
+            'Body': body
+        }
+        
+        if media_url:
+            data['MediaUrl'] = media_url
+        
+        for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+            try:
+                session = await get_http_session()
+                async with session.post(self.messages_url, data=data, auth=self.auth) as resp:
+                    if resp.status not in RETRY_STATUSES or attempt == RETRY_MAX_ATTEMPTS:
+                        message = await resp.json(content_type=None)
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                # Twilio has no idempotency key for message creation, so only
+                # failures to connect are known not to have sent anything.
+                if not isinstance(e, aiohttp.ClientConnectorError) or attempt == RETRY_MAX_ATTEMPTS:
+                    return {
+                        'success': False,
+                        'error': str(e),
+                        'error_code': None,
+                        'to': recipient
+                    }
+            await asyncio.sleep(backoff_delay(attempt))
+        
+        if resp.status >= 400:
             return {
                 'success': False,
-                'error': str(e),
-                'error_code': e.code,
+                'error': message.get('message', f"HTTP {resp.status}"),
+                'error_code': message.get('code'),
                 'to': recipient
             }
+        
+        return {
+            'success': True,
+            'message_sid': message.get('sid'),
+            'status': message.get('status'),
+            'to': recipient,
+            'from': self.from_number
+        }
     
-    def send_message_to_default(self, body: str, media_url: Optional[str] = None) -> dict:
-        return self.send_message(body, media_url=media_url)
+    def send_message_sync(
+        self, 
+        body: str, 
+        to_number: Optional[str] = None,
+        media_url: Optional[str] = None
+    ) -> dict:
+        async def send_and_close() -> dict:
+            try:
+                return await self.send_message(body, to_number, media_url)
+            finally:
+                # The shared session is bound to this short-lived event loop.
+                await close_http_session()
+        
+        return asyncio.run(send_and_close())
+    
+    async def send_message_to_default(self, body: str, media_url: Optional[str] = None) -> dict:
+        return await self.send_message(body, media_url=media_url)
     
     def get_message_status(self, message_sid: str) -> dict:
+        from twilio.base.exceptions import TwilioRestException
+        
+        cached = self._status_cache.get(message_sid)
+        if cached is not None:
+            fetched_at, result = cached
+            if (
+                result['status'] in TERMINAL_MESSAGE_STATUSES
+                or time.monotonic() - fetched_at < STATUS_CACHE_TTL
+            ):
+                return result
+        
         try:
             message = self.client.messages(message_sid).fetch()
             
-            return {
+            result = {
                 'success': True,
                 'message_sid': message.sid,
                 'status': message.status,
@@ -82,6 +204,10 @@ class WhatsAppMessenger:
                 'error_code': message.error_code,
                 'error_message': message.error_message
             }
+            if len(self._status_cache) >= STATUS_CACHE_MAX_SIZE:
+                self._status_cache.clear()
+            self._status_cache[message_sid] = (time.monotonic(), result)
+            return result
             
         except TwilioRestException as e:
             return {
@@ -89,35 +215,69 @@ class WhatsAppMessenger:
                 'error': str(e),
                 'error_code': e.code
             }
+    
+    async def get_message_status_async(self, message_sid: str) -> dict:
+        # The Twilio SDK fetch blocks; run it on the loop's default executor.
+        return await asyncio.to_thread(self.get_message_status, message_sid)
 
 
-_messenger_instance = None
+_messenger_instance: Optional[WhatsAppMessenger] = None
+_messenger_lock = threading.Lock()
 
 def get_messenger() -> WhatsAppMessenger:
     global _messenger_instance
     if _messenger_instance is None:
-        _messenger_instance = WhatsAppMessenger()
+        # Double-checked so concurrent cold starts build a single client.
+        with _messenger_lock:
+            if _messenger_instance is None:
+                _messenger_instance = WhatsAppMessenger()
     return _messenger_instance
 
 
-def send_whatsapp_message(body: str, to_number: Optional[str] = None, media_url: Optional[str] = None) -> dict:
+async def send_whatsapp_message(body: str, to_number: Optional[str] = None, media_url: Optional[str] = None) -> dict:
     messenger = get_messenger()
-    return messenger.send_message(body, to_number, media_url)
+    return await messenger.send_message(body, to_number, media_url)
 
 
-def send_order_notification(order_id: int, customer_name: str, order_details: str) -> dict:
-    message = f"""
-*New Order - #{order_id}*
-
-Customer: {customer_name}
+async def send_bulk_messages(
+    messages: list[dict],
+    max_concurrency: int = 50,
+    rate_per_sec: float = 50
+) -> list:
+    messenger = get_messenger()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    interval = 1.0 / rate_per_sec
+    next_slot = time.monotonic()
+    
+    async def send(message: dict) -> dict:
+        nonlocal next_slot
+        async with semaphore:
+            # Token bucket: each send claims the next free slot so the
+            # overall rate stays under Twilio's per-sender throughput.
+            slot = max(next_slot, time.monotonic())
+            next_slot = slot + interval
+            delay = slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return await messenger.send_message(
+                message['body'],
+                message.get('to_number'),
+                message.get('media_url')
+            )
+    
+    return await asyncio.gather(
+        *(send(message) for message in messages),
+        return_exceptions=True
+    )
 
-Order details:
-{order_details}
 
-Please confirm receipt of this order!
-    """.strip()
-    
-    return send_whatsapp_message(message)
+async def send_order_notification(order_id: int, customer_name: str, order_details: str) -> dict:
+    message = _ORDER_TMPL.format_map({
+        'order_id': order_id,
+        'customer_name': customer_name,
+        'order_details': order_details
+    })
+    return await send_whatsapp_message(message)
 
 
 if __name__ == "__main__":
@@ -128,7 +288,7 @@ if __name__ == "__main__":
         print(f"  To: {messenger.to_number}")
         
         print("\nSending test message...")
-        response = messenger.send_message_to_default(
+        response = messenger.send_message_sync(
             "Hello! This is a test message from OrderFlow"
         )
         
@@ -0,0 +1,14 @@
+import asyncio
+
+from db import get_engine, init_db, run_migrations
+
+
+async def main() -> None:
+	await init_db()
+	await run_migrations()
+	await get_engine().dispose()
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
+	print("Database schema is up to date")
@@ -1,32 +1,155 @@
-import os
+import asyncio
+import logging
+import threading
+import time
+import uuid
 from typing import Optional, Dict, Any
-from decimal import Decimal
-import mercadopago
-from dotenv import load_dotenv
+from decimal import Decimal, localcontext
+import httpx
+import orjson
 
-load_dotenv()
+from config import get_settings
+from retry import RETRY_MAX_ATTEMPTS, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+STATUS_CACHE_TTL = 2.0
+STATUS_CACHE_MAX_SIZE = 10_000
+TERMINAL_PAYMENT_STATUSES = frozenset({'rejected', 'cancelled', 'refunded', 'charged_back'})
+
+_HTTP_OK = frozenset({200, 201})
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+MISSING_MP_CREDENTIALS = (
+    "Missing Mercado Pago credentials. Please check your .env file for "
+    "MP_ACCESS_TOKEN"
+)
+MISSING_TEST_CARD_NUMBER = "Missing TEST_CARD_NUMBER. Please check your .env file for TEST_CARD_NUMBER"
+
+MP_PREFERENCES_URL = "https://api.mercadopago.com/checkout/preferences"
+
+_mp_client: Optional[httpx.AsyncClient] = None
+
+
+def get_mp_client() -> httpx.AsyncClient:
+    global _mp_client
+    if _mp_client is None or _mp_client.is_closed:
+        _mp_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=10.0
+        )
+    return _mp_client
+
+
+async def close_mp_client() -> None:
+    global _mp_client
+    if _mp_client is not None and not _mp_client.is_closed:
+        await _mp_client.aclose()
+    _mp_client = None
+
+
+def _build_sdk(access_token: str):
+    # mercadopago pulls in requests/urllib3, so it is imported only when a
+    # payment lookup actually needs the SDK.
+    import mercadopago
+    from mercadopago.http.http_client import HttpClient
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    class KeepAliveHttpClient(HttpClient):
+        # The SDK's default client opens a fresh requests.Session (and TLS
+        # handshake) per call; this one keeps a pooled session for reuse.
+        
+        def __init__(self):
+            self.session = Session()
+            self.session.mount('https://', HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=32,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=[429, 500, 502, 503, 504]
+                )
+            ))
+        
+        def request(self, method, url, maxretries=None, **kwargs):
+            api_result = self.session.request(method, url, **kwargs)
+            return {
+                "status": api_result.status_code,
+                "response": api_result.json()
+            }
+    
+    return mercadopago.SDK(access_token, http_client=KeepAliveHttpClient())
 
 
 class MercadoPagoPayment:
     
     def __init__(self):
-        self.access_token = os.getenv('MP_ACCESS_TOKEN')
-        self.test_card_number = os.getenv('TEST_CARD_NUMBER')
+        settings = get_settings()
+        self.access_token = settings.mp_token
+        self.test_card_number = settings.test_card_number
+        self._debug = settings.mp_debug
         
         if not self.access_token:
-            raise ValueError(
-                "Missing Mercado Pago credentials. Please check your .env file for "
-                "MP_ACCESS_TOKEN"
-            )
+            raise ValueError(MISSING_MP_CREDENTIALS)
         
         if not self.test_card_number:
-            raise ValueError(
-                "Missing TEST_CARD_NUMBER. Please check your .env file for TEST_CARD_NUMBER"
-            )
+            raise ValueError(MISSING_TEST_CARD_NUMBER)
+        
+        self._sdk = None
+        self._status_cache: dict[str, tuple[float, Dict[str, Any]]] = {}
         
-        self.sdk = mercadopago.SDK(self.access_token)
+        # Immutable part of every preference; the nested dicts are shared
+        # across requests and must not be mutated.
+        self._base_pref = {
+            "back_urls": {
+                "success": "https://www.tu-sitio.com/success",
+                "failure": "https://www.tu-sitio.com/failure",
+                "pending": "https://www.tu-sitio.com/pending"
+            },
+            "auto_return": "approved",
+            "payment_methods": {
+                "excluded_payment_types": [],
+                "installments": 1
+            },
+            "statement_descriptor": settings.business_name,
+        }
     
-    def create_payment_link(
+    @property
+    def sdk(self):
+        if self._sdk is None:
+            self._sdk = _build_sdk(self.access_token)
+        return self._sdk
+    
+    async def _create_preference(self, preference_data: Dict[str, Any]) -> Dict[str, Any]:
+        # The idempotency key is shared by every attempt, so a retried request
+        # that already reached Mercado Pago does not create a second preference.
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json',
+            'X-Idempotency-Key': uuid.uuid4().hex
+        }
+        content = orjson.dumps(preference_data)
+        client = get_mp_client()
+        
+        for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+            try:
+                response = await client.post(MP_PREFERENCES_URL, content=content, headers=headers)
+            except httpx.TransportError:
+                if attempt == RETRY_MAX_ATTEMPTS:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == RETRY_MAX_ATTEMPTS:
+                    return {
+                        "status": response.status_code,
+                        "response": orjson.loads(response.content)
+                    }
+            await asyncio.sleep(backoff_delay(attempt))
+    
+    async def create_payment_link(
         self,
         title: str,
         amount: float,
@@ -36,6 +159,7 @@ class MercadoPagoPayment:
     ) -> Dict[str, Any]:
         try:
             preference_data = {
+                **self._base_pref,
                 "items": [
                     {
                         "title": title,
@@ -45,28 +169,14 @@ class MercadoPagoPayment:
                         "currency_id": "ARS"  
                     }
                 ],
-                "back_urls": {
-                    "success": "https://www.tu-sitio.com/success",
-                    "failure": "https://www.tu-sitio.com/failure",
-                    "pending": "https://www.tu-sitio.com/pending"
-                },
-                "auto_return": "approved",
-                "payment_methods": {
-                    "excluded_payment_types": [],
-                    "installments": 1 
-                },
-                "statement_descriptor": os.getenv('BUSINESS_NAME', 'Mi Negocio'),
+                **({"external_reference": str(external_reference)} if external_reference else {}),
             }
             
-            if external_reference:
-                preference_data["external_reference"] = str(external_reference)
-            
-            preference_response = self.sdk.preference().create(preference_data)
+            preference_response = await self._create_preference(preference_data)
 
-            if preference_response["status"] not in [200, 201]:
+            if preference_response["status"] not in _HTTP_OK:
                 error_details = preference_response.get('response', {})
                 error_msg = error_details.get('message', 'Unknown error')
-                error_cause = error_details.get('cause', [])
                 
                 return {
                     'success': False,
@@ -77,7 +187,10 @@ class MercadoPagoPayment:
             
             preference = preference_response["response"]
             
-            return {
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Preference %s created with keys %s", preference.get('id'), list(preference.keys()))
+            
+            result = {
                 'success': True,
                 'payment_link': preference.get('init_point'), 
                 'payment_link_mobile': preference.get('sandbox_init_point'), 
@@ -86,64 +199,77 @@ class MercadoPagoPayment:
                 'amount': amount,
                 'quantity': quantity,
                 'total': amount * quantity,
-                'test_card_number': self.test_card_number,  
-                'raw_response': preference 
+                'test_card_number': self.test_card_number
             }
+            if self._debug:
+                result['raw_response'] = preference
+            return result
             
         except Exception as e:
-            import traceback
+            logger.exception("Payment link creation failed")
             return {
                 'success': False,
-                'error': str(e),
-                'traceback': traceback.format_exc()
+                'error': str(e)
             }
     
-    def create_order_payment(
+    async def create_order_payment(
         self,
         order_id: int,
         items: list[Dict[str, Any]],
         customer_name: Optional[str] = None
     ) -> Dict[str, Any]:
         try:
-            total = sum(item['price'] * item.get('quantity', 1) for item in items)
+            total = Decimal(0)
+            pref_items = []
+            desc_lines = []
+            with localcontext() as ctx:
+                ctx.prec = 12
+                for item in items:
+                    name = item['name']
+                    price = Decimal(str(item['price']))
+                    qty = item.get('quantity', 1)
+                    total += price * Decimal(str(qty))
+                    pref_items.append({
+                        "title": name,
+                        "description": item.get('description', name),
+                        "quantity": qty,
+                        "unit_price": float(price),
+                        "currency_id": "ARS"
+                    })
+                    desc_lines.append(f"- {name} x{qty} (${item['price']})")
             
             if len(items) == 1:
                 title = f"Orden #{order_id} - {items[0]['name']}"
             else:
                 title = f"Orden #{order_id} - {len(items)} productos"
             
-            items_desc = "\n".join([
-                f"- {item['name']} x{item.get('quantity', 1)} (${item['price']})"
-                for item in items
-            ])
+            items_desc = "\n".join(desc_lines)
             description = f"Orden para {customer_name or 'Cliente'}\n{items_desc}"
             
             preference_data = {
-                "items": [
-                    {
-                        "title": item['name'],
-                        "description": item.get('description', item['name']),
-                        "quantity": item.get('quantity', 1),
-                        "unit_price": float(item['price']),
-                        "currency_id": "ARS"
-                    }
-                    for item in items
-                ],
+                **self._base_pref,
+                "items": pref_items,
                 "external_reference": f"order_{order_id}",
                 "back_urls": {
                     "success": f"https://www.tu-sitio.com/order/{order_id}/success",
                     "failure": f"https://www.tu-sitio.com/order/{order_id}/failure",
                     "pending": f"https://www.tu-sitio.com/order/{order_id}/pending"
                 },
-                "auto_return": "approved",
-                "payment_methods": {
-                    "excluded_payment_types": [],
-                    "installments": 1
-                },
-                "statement_descriptor": os.getenv('BUSINESS_NAME', 'Mi Negocio'),
             }
             
-            preference_response = self.sdk.preference().create(preference_data)
+            preference_response = await self._create_preference(preference_data)
+
+            if preference_response["status"] not in _HTTP_OK:
+                error_details = preference_response.get('response', {})
+                error_msg = error_details.get('message', 'Unknown error')
+                
+                return {
+                    'success': False,
+                    'error': f"API returned status {preference_response['status']}: {error_msg}",
+                    'status_code': preference_response['status'],
+                    'order_id': order_id
+                }
+            
             preference = preference_response["response"]
             
             return {
@@ -158,6 +284,7 @@ class MercadoPagoPayment:
             }
             
         except Exception as e:
+            logger.exception("Order payment link creation failed for order %s", order_id)
             return {
                 'success': False,
                 'error': str(e),
@@ -165,11 +292,20 @@ class MercadoPagoPayment:
             }
     
     def get_payment_info(self, payment_id: str) -> Dict[str, Any]:
+        cached = self._status_cache.get(payment_id)
+        if cached is not None:
+            fetched_at, result = cached
+            if (
+                result['status'] in TERMINAL_PAYMENT_STATUSES
+                or time.monotonic() - fetched_at < STATUS_CACHE_TTL
+            ):
+                return result
+        
         try:
             payment_response = self.sdk.payment().get(payment_id)
             payment = payment_response["response"]
             
-            return {
+            result = {
                 'success': True,
                 'payment_id': payment.get('id'),
                 'status': payment.get('status'),
@@ -180,24 +316,36 @@ class MercadoPagoPayment:
                 'date_created': payment.get('date_created'),
                 'date_approved': payment.get('date_approved')
             }
+            if len(self._status_cache) >= STATUS_CACHE_MAX_SIZE:
+                self._status_cache.clear()
+            self._status_cache[payment_id] = (time.monotonic(), result)
+            return result
             
         except Exception as e:
             return {
                 'success': False,
                 'error': str(e)
             }
+    
+    async def get_payment_info_async(self, payment_id: str) -> Dict[str, Any]:
+        # The Mercado Pago SDK call blocks; run it on the loop's default executor.
+        return await asyncio.to_thread(self.get_payment_info, payment_id)
 
 
-_payment_instance = None
+_payment_instance: Optional[MercadoPagoPayment] = None
+_payment_lock = threading.Lock()
 
 def get_payment_service() -> MercadoPagoPayment:
     global _payment_instance
     if _payment_instance is None:
-        _payment_instance = MercadoPagoPayment()
+        # Double-checked so concurrent cold starts build a single client.
+        with _payment_lock:
+            if _payment_instance is None:
+                _payment_instance = MercadoPagoPayment()
     return _payment_instance
 
 
-def create_payment_link(
+async def create_payment_link(
     title: str,
     amount: float,
     description: Optional[str] = None,
@@ -205,7 +353,7 @@ def create_payment_link(
     external_reference: Optional[str] = None
 ) -> Dict[str, Any]:
     payment_service = get_payment_service()
-    return payment_service.create_payment_link(
+    return await payment_service.create_payment_link(
         title=title,
         amount=amount,
         description=description,
@@ -214,29 +362,40 @@ def create_payment_link(
     )
 
 
-def create_order_payment_link(
+async def create_order_payment_link(
     order_id: int,
     items: list[Dict[str, Any]],
     customer_name: Optional[str] = None
 ) -> Dict[str, Any]:
     payment_service = get_payment_service()
-    return payment_service.create_order_payment(
+    return await payment_service.create_order_payment(
         order_id=order_id,
         items=items,
         customer_name=customer_name
     )
 
 
+def run_sync(coro):
+    async def run_and_close():
+        try:
+            return await coro
+        finally:
+            # The shared client is bound to this short-lived event loop.
+            await close_mp_client()
+    
+    return asyncio.run(run_and_close())
+
+
 if __name__ == "__main__":
     try:
         payment_service = MercadoPagoPayment()
-        result = payment_service.create_payment_link(
+        result = run_sync(payment_service.create_payment_link(
             title="Empanadas x6",
             amount=2500.00,
             description="Media docena de empanadas de carne",
             quantity=1,
             external_reference="test_001"
-        )
+        ))
         
         if result['success']:
             print(f"Payment link created!")
@@ -249,14 +408,14 @@ if __name__ == "__main__":
         
         # Test creating an order payment
         print("\nCreating order payment link...")
-        order_result = payment_service.create_order_payment(
+        order_result = run_sync(payment_service.create_order_payment(
             order_id=123,
             items=[
                 {'name': 'Empanadas de carne', 'price': 1200, 'quantity': 6},
                 {'name': 'Coca Cola 1.5L', 'price': 800, 'quantity': 1}
             ],
             customer_name="Juan Pérez"
-        )
+        ))
         
         if order_result['success']:
             print(f"Order payment link created!")
@@ -0,0 +1,9 @@
+import random
+
+RETRY_MAX_ATTEMPTS = 4
+RETRY_INITIAL_DELAY = 0.2
+RETRY_MAX_DELAY = 2.0
+
+
+def backoff_delay(attempt: int) -> float:
+    return min(RETRY_MAX_DELAY, RETRY_INITIAL_DELAY * 2 ** (attempt - 1)) + random.uniform(0, RETRY_INITIAL_DELAY)